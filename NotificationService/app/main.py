@@ -3,12 +3,14 @@ import json
 import os
 import uuid
 from datetime import datetime, timezone
+from enum import Enum
 from typing import Any, Dict, List, Optional, Set
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, status, APIRouter
+import orjson
+from fastapi import FastAPI, WebSocket, HTTPException, status, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, validator
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
 
 # -----------------------------------------------------------------------------
 # FastAPI app with OpenAPI metadata and tags
@@ -18,17 +20,22 @@ app = FastAPI(
     title="Notification Service API",
     description="Sends notifications via in-app, email, SMS, and supports WebSocket streams.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     openapi_tags=[
         {"name": "Notifications", "description": "Realtime notifications publishing and streaming"},
     ],
 )
 
-# CORS setup (liberal defaults for demo; adjust in production via env)
-allowed_origins = os.getenv("CORS_ALLOWED_ORIGINS", "*")
+# CORS setup (liberal defaults for demo; adjust in production via env).
+# Parsed exactly once at import time. A lone "*" takes Starlette's wildcard fast path; credentials
+# cannot be combined with a wildcard origin per the CORS spec, so they are only allowed for explicit origins.
+ALLOWED_ORIGINS = tuple(
+    o.strip() for o in os.getenv("CORS_ALLOWED_ORIGINS", "*").split(",") if o.strip()
+) or ("*",)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[o.strip() for o in allowed_origins.split(",")] if allowed_origins else ["*"],
-    allow_credentials=True,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=ALLOWED_ORIGINS != ("*",),
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -40,14 +47,14 @@ router = APIRouter()
 # Pydantic Models aligned with openapi/notification.yaml
 # -----------------------------------------------------------------------------
 
-class NotificationType(str):
+class NotificationType(str, Enum):
     ORDER_UPDATE = "order_update"
     PROMOTION = "promotion"
     SYSTEM = "system"
     REVIEW_EVENT = "review_event"
 
 
-class Channel(str):
+class Channel(str, Enum):
     IN_APP = "in_app"
     EMAIL = "email"
     SMS = "sms"
@@ -59,7 +66,9 @@ class Notification(BaseModel):
     id: str = Field(..., description="Unique notification identifier")
     userId: Optional[str] = Field(None, description="User ID the notification targets")
     orderId: Optional[str] = Field(None, description="Order ID associated with the notification")
-    type: str = Field(..., description="Type of notification (order_update, promotion, system, review_event)")
+    type: NotificationType = Field(
+        ..., description="Type of notification (order_update, promotion, system, review_event)"
+    )
     title: str = Field(..., description="Notification title")
     body: Optional[str] = Field(None, description="Notification body")
     data: Optional[Dict[str, Any]] = Field(None, description="Additional metadata payload")
@@ -69,39 +78,53 @@ class Notification(BaseModel):
 
 class NotificationCreateRequest(BaseModel):
     """Request payload for creating/publishing a new notification."""
+    # type/channels are validated against the enums by pydantic-core; keep plain string values on the model.
+    model_config = ConfigDict(use_enum_values=True)
+
     userId: Optional[str] = Field(None, description="Target user identifier (optional)")
     topic: Optional[str] = Field(None, description="Target topic to broadcast to (optional)")
     orderId: Optional[str] = Field(None, description="Associated order identifier (optional)")
-    type: str = Field(..., description="Type of notification (order_update, promotion, system, review_event)")
+    type: NotificationType = Field(
+        ..., description="Type of notification (order_update, promotion, system, review_event)"
+    )
     title: str = Field(..., description="Notification title")
     body: Optional[str] = Field(None, description="Notification body")
     data: Optional[Dict[str, Any]] = Field(None, description="Arbitrary key-value payload")
-    channels: Optional[List[str]] = Field(
+    channels: Optional[List[Channel]] = Field(
         None,
         description="Delivery channels (in_app, email, sms, push). Only in_app is implemented in this service."
     )
 
-    @validator("type")
-    def validate_type(cls, v: str) -> str:
-        allowed = {NotificationType.ORDER_UPDATE, NotificationType.PROMOTION, NotificationType.SYSTEM, NotificationType.REVIEW_EVENT}
-        if v not in allowed:
-            raise ValueError(f"type must be one of {sorted(list(allowed))}")
-        return v
-
-    @validator("channels", each_item=True)
-    def validate_channel(cls, v: Optional[str]) -> Optional[str]:
-        if v is None:
-            return v
-        allowed = {Channel.IN_APP, Channel.EMAIL, Channel.SMS, Channel.PUSH}
-        if v not in allowed:
-            raise ValueError(f"channels items must be one of {sorted(list(allowed))}")
-        return v
-
 
 # -----------------------------------------------------------------------------
 # In-memory Broker
 # -----------------------------------------------------------------------------
 
+def frame(payload: bytes) -> bytes:
+    """Prefix an encoded message with its 4-byte big-endian length for the stream wire format."""
+    return len(payload).to_bytes(4, "big") + payload
+
+
+def _json_default(value: Any) -> Any:
+    """Serialize the non-JSON types a notification may carry for the stdlib json fallback."""
+    if isinstance(value, datetime):
+        # Match orjson's OPT_UTC_Z rendering so the fallback is indistinguishable on the wire.
+        return value.isoformat().replace("+00:00", "Z")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Subscription:
+    """Per-connection state: the client's filters plus its outbound queue and writer task."""
+
+    __slots__ = ("user_id", "topic", "outbox", "writer")
+
+    def __init__(self, user_id: Optional[str], topic: Optional[str], outbox_size: int) -> None:
+        self.user_id = user_id or None
+        self.topic = topic or None
+        self.outbox: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=outbox_size)
+        self.writer: Optional["asyncio.Task[None]"] = None
+
+
 class ConnectionManager:
     """
     Manages active WebSocket connections and their subscriptions.
@@ -111,24 +134,217 @@ class ConnectionManager:
       We store their subscription interests for simple filtering.
     """
 
-    def __init__(self) -> None:
-        # Store all active websockets
-        self.active_connections: Set[WebSocket] = set()
-        # Simple subscription metadata (maps websocket to filters)
-        self.subscriptions: Dict[WebSocket, Dict[str, Optional[str]]] = {}
-        # Asyncio lock to avoid race conditions on connection add/remove/broadcast
-        self._lock = asyncio.Lock()
+    def __init__(self, outbox_size: int = 256) -> None:
+        # Maximum number of undelivered payloads buffered per connection. A client that falls this far
+        # behind is disconnected instead of letting its queue grow without bound.
+        self._outbox_size = outbox_size
+        # Close handshakes for evicted slow clients, kept referenced until they finish.
+        self._closing: Set["asyncio.Task[None]"] = set()
+        # Subscription state per websocket; its keys are the active websockets
+        self.subscriptions: Dict[WebSocket, Subscription] = {}
+        # Secondary indices so broadcasts only touch matching sockets instead of scanning them all.
+        # Sockets without a userId (resp. topic) filter accept any value and live in any_user (any_topic).
+        self.by_user: Dict[str, Set[WebSocket]] = {}
+        self.by_topic: Dict[str, Set[WebSocket]] = {}
+        self.any_user: Set[WebSocket] = set()
+        self.any_topic: Set[WebSocket] = set()
+        # No lock is needed: the event loop is single-threaded and none of the bookkeeping below
+        # awaits between reading and mutating these structures.
 
     async def connect(self, websocket: WebSocket, user_id: Optional[str], topic: Optional[str]) -> None:
         await websocket.accept()
-        async with self._lock:
-            self.active_connections.add(websocket)
-            self.subscriptions[websocket] = {"userId": user_id, "topic": topic}
+        sub = Subscription(user_id, topic, self._outbox_size)
+        self.subscriptions[websocket] = sub
+        self._add_to_index(self.by_user, self.any_user, sub.user_id, websocket)
+        self._add_to_index(self.by_topic, self.any_topic, sub.topic, websocket)
+        # Each connection's outbound queue is drained by a dedicated writer task, so broadcast never
+        # awaits socket I/O and bursts of notifications are coalesced into a single frame.
+        sub.writer = asyncio.create_task(self._writer(websocket, sub.outbox))
 
     async def disconnect(self, websocket: WebSocket) -> None:
-        async with self._lock:
-            self.active_connections.discard(websocket)
-            self.subscriptions.pop(websocket, None)
+        self._remove(websocket)
+
+    @staticmethod
+    def _add_to_index(
+        index: Dict[str, Set[WebSocket]], wildcard: Set[WebSocket], key: Optional[str], websocket: WebSocket
+    ) -> None:
+        if key:
+            index.setdefault(key, set()).add(websocket)
+        else:
+            wildcard.add(websocket)
+
+    @staticmethod
+    def _remove_from_index(
+        index: Dict[str, Set[WebSocket]], wildcard: Set[WebSocket], key: Optional[str], websocket: WebSocket
+    ) -> None:
+        if not key:
+            wildcard.discard(websocket)
+            return
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(websocket)
+            if not bucket:
+                del index[key]
+
+    async def _writer(self, websocket: WebSocket, outbox: "asyncio.Queue[bytes]") -> None:
+        """
+        Deliver queued payloads to a single client.
+
+        Blocks for the first payload, then drains whatever else is already queued and sends the
+        whole batch as one binary WebSocket frame of concatenated length-prefixed messages.
+        Returns on send failure; broadcast prunes the socket.
+
+        Each writer has at most one send in flight, and broadcast only enqueues, so a large fan-out
+        costs one queue put per recipient rather than one coroutine per send.
+        """
+        while True:
+            batch = [await outbox.get()]
+            while True:
+                try:
+                    batch.append(outbox.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await websocket.send_bytes(b"".join(batch))
+            except Exception:
+                return
+
+    @staticmethod
+    def _stop_writer(sub: Subscription) -> None:
+        if sub.writer is not None and sub.writer is not asyncio.current_task():
+            sub.writer.cancel()
+
+    def _remove(self, websocket: WebSocket) -> None:
+        """Drop a websocket from all bookkeeping structures. Safe to call more than once."""
+        sub = self.subscriptions.pop(websocket, None)
+        if sub is None:
+            return
+        self._stop_writer(sub)
+        self._remove_from_index(self.by_user, self.any_user, sub.user_id, websocket)
+        self._remove_from_index(self.by_topic, self.any_topic, sub.topic, websocket)
+
+    def _remove_many(self, websockets: Set[WebSocket]) -> None:
+        """
+        Drop several websockets at once, e.g. after a disconnect storm.
+
+        Wildcard sets are pruned with a single set difference and every touched index bucket is
+        pruned once, rather than walking each structure per socket.
+        """
+        self.any_user -= websockets
+        self.any_topic -= websockets
+        users: Set[str] = set()
+        topics: Set[str] = set()
+        for ws in websockets:
+            sub = self.subscriptions.pop(ws, None)
+            if sub is None:
+                continue
+            self._stop_writer(sub)
+            if sub.user_id:
+                users.add(sub.user_id)
+            if sub.topic:
+                topics.add(sub.topic)
+        for user_id in users:
+            self._prune_bucket(self.by_user, user_id, websockets)
+        for topic in topics:
+            self._prune_bucket(self.by_topic, topic, websockets)
+
+    @staticmethod
+    def _prune_bucket(index: Dict[str, Set[WebSocket]], key: str, websockets: Set[WebSocket]) -> None:
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket -= websockets
+            if not bucket:
+                del index[key]
+
+    def _recipients(self, user_id: Any, topic: Any) -> Set[WebSocket]:
+        """
+        Resolve the sockets whose filters match the given userId/topic.
+
+        Subscription filters are always strings, and data.topic may be any JSON value. A non-string
+        key (e.g. a list) can therefore never equal a filter and only reaches wildcard subscribers.
+        """
+        users = self.any_user
+        if isinstance(user_id, str) and user_id in self.by_user:
+            users = users | self.by_user[user_id]
+        if not users:
+            return set()
+        topics = self.any_topic
+        if isinstance(topic, str) and topic in self.by_topic:
+            topics = topics | self.by_topic[topic]
+        return users & topics
+
+    @staticmethod
+    def encode(message: Dict[str, Any]) -> bytes:
+        """
+        Serialize and frame a message once for delivery to any number of recipients.
+
+        orjson handles datetime/UUID natively, so no broad default=str is used. orjson still rejects
+        some valid JSON input (integers beyond 64 bits), so any message it cannot encode is
+        retried with stdlib json. That fallback covers everything a parsed request body can contain.
+        Only non-JSON Python objects passed in by other callers raise TypeError, from the narrow
+        _json_default. The resulting bytes are shared by every recipient, so nothing is re-encoded
+        or re-framed per connection.
+        """
+        try:
+            encoded = orjson.dumps(message, option=orjson.OPT_UTC_Z)
+        except orjson.JSONEncodeError:
+            # orjson rejects some valid JSON input, e.g. integers beyond 64 bits; stdlib json does not.
+            encoded = json.dumps(message, default=_json_default, separators=(",", ":")).encode()
+        return frame(encoded)
+
+    def _deliver(self, payload: bytes, recipients: Set[WebSocket]) -> None:
+        """
+        Hand an encoded payload to the writer tasks of the given sockets.
+
+        Nothing here awaits, so the recipient set cannot change underneath us and a slow client
+        cannot stall the publisher.
+        """
+        subscriptions = self.subscriptions
+        to_remove: Set[WebSocket] = set()
+        for ws in recipients:
+            sub = subscriptions[ws]
+            if sub.writer.done():
+                # Writer stopped after a failed send: mark broken connection for removal
+                to_remove.add(ws)
+                continue
+            try:
+                sub.outbox.put_nowait(payload)
+            except asyncio.QueueFull:
+                # Slow consumer: evict it rather than buffer without bound; the client can reconnect.
+                to_remove.add(ws)
+                self._close_later(ws)
+
+        if to_remove:
+            self._remove_many(to_remove)
+
+    def _close_later(self, websocket: WebSocket) -> None:
+        task = asyncio.create_task(self._close(websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(websocket: WebSocket) -> None:
+        try:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            # The socket may already be gone; it is no longer tracked either way.
+            pass
+
+    @staticmethod
+    def message_topic(message: Dict[str, Any]) -> Any:
+        """Return a message's routing topic: the top-level 'topic', else data.topic."""
+        return message.get("topic") or (message.get("data") or {}).get("topic")
+
+    async def send_to_user(self, user_id: str, message: Dict[str, Any]) -> None:
+        """
+        Deliver a message targeted at a single user.
+
+        Only the user's own sockets and subscribers without a userId filter are considered, with
+        the same topic filtering as broadcast. The message is only encoded if someone will receive it.
+        """
+        recipients = self._recipients(user_id, self.message_topic(message))
+        if recipients:
+            self._deliver(self.encode(message), recipients)
 
     async def broadcast(self, message: Dict[str, Any]) -> None:
         """
@@ -137,37 +353,14 @@ class ConnectionManager:
         - If a client subscribed with topic, it will receive messages where message.data.topic matches client topic,
           or if the message has explicit top-level 'topic' field set.
         """
-        data_text = json.dumps(message, default=str)
-        async with self._lock:
-            to_remove: List[WebSocket] = []
-            for ws in list(self.active_connections):
-                filters = self.subscriptions.get(ws, {})
-                user_filter = filters.get("userId")
-                topic_filter = filters.get("topic")
-
-                # Determine matching
-                matches_user = True
-                if user_filter:
-                    matches_user = (message.get("userId") == user_filter)
-
-                # topic could be provided either as top-level or in data
-                msg_topic = message.get("topic")
-                if not msg_topic:
-                    msg_topic = (message.get("data") or {}).get("topic")
-                matches_topic = True
-                if topic_filter:
-                    matches_topic = (msg_topic == topic_filter)
-
-                if matches_user and matches_topic:
-                    try:
-                        await ws.send_text(data_text)
-                    except Exception:
-                        # Mark broken connections for removal
-                        to_remove.append(ws)
-
-            for ws in to_remove:
-                self.active_connections.discard(ws)
-                self.subscriptions.pop(ws, None)
+        if not self.subscriptions:
+            return
+
+        # Routing keys are resolved once per broadcast, never per connection.
+        # Skip the encode entirely when no subscriber matches.
+        recipients = self._recipients(message.get("userId"), self.message_topic(message))
+        if recipients:
+            self._deliver(self.encode(message), recipients)
 
 
 manager = ConnectionManager()
@@ -198,27 +391,32 @@ async def post_notification(payload: NotificationCreateRequest):
     Returns:
     - 202 Accepted with a JSON body { "status": "accepted", "id": "<notification_id>" }
     """
-    notification = Notification(
-        id=str(uuid.uuid4()),
-        userId=payload.userId,
-        orderId=payload.orderId,
-        type=payload.type,
-        title=payload.title,
-        body=payload.body,
-        data=payload.data,
-        createdAt=datetime.now(timezone.utc),
-    )
-    # Prepare message to broadcast. Add topic if provided to ease filtering.
-    message: Dict[str, Any] = notification.dict()
+    # Build the broadcast message directly in the Notification shape; the request payload is
+    # already validated, so constructing and dumping a Notification model would be pure overhead.
+    notification_id = str(uuid.uuid4())
+    message: Dict[str, Any] = {
+        "id": notification_id,
+        "userId": payload.userId,
+        "orderId": payload.orderId,
+        "type": payload.type,
+        "title": payload.title,
+        "body": payload.body,
+        "data": payload.data,
+        "read": False,
+        "createdAt": datetime.now(timezone.utc),
+    }
+    # Add topic if provided to ease filtering.
     if payload.topic:
         message["topic"] = payload.topic
 
-    await manager.broadcast(message)
+    if payload.userId:
+        # Targeted notifications (the common order-update case) go straight to the user's sockets.
+        await manager.send_to_user(payload.userId, message)
+    else:
+        await manager.broadcast(message)
 
-    return JSONResponse(
-        status_code=status.HTTP_202_ACCEPTED,
-        content={"status": "accepted", "id": notification.id},
-    )
+    # Plain dict: serialized by the app-level ORJSONResponse with the route's 202 status code.
+    return {"status": "accepted", "id": notification_id}
 
 
 # PUBLIC_INTERFACE
@@ -227,7 +425,9 @@ async def post_notification(payload: NotificationCreateRequest):
     tags=["Notifications"],
     summary="WebSocket endpoint",
     description="Upgrades to WebSocket for real-time notifications. "
-                "Connect using ws://host:port/notifications/stream?userId=<id>&topic=<topic>",
+                "Connect using ws://host:port/notifications/stream?userId=<id>&topic=<topic>. "
+                "Notifications arrive as binary frames holding one or more messages, each encoded as a "
+                "4-byte big-endian length followed by that many bytes of UTF-8 JSON.",
     responses={
         101: {"description": "Switching Protocols"},
         400: {"description": "Bad Request"},
@@ -237,10 +437,14 @@ async def websocket_help():
     """
     Helper endpoint documented for OpenAPI to indicate WebSocket usage.
     See the /ws implementation mounted separately for the actual WebSocket connection.
+
+    Wire format: every binary frame is a concatenation of one or more records of the form
+    [4-byte big-endian length][UTF-8 JSON Notification]. Read the length, parse that many bytes,
+    and repeat until the frame is consumed.
     """
-    return JSONResponse(
-        status_code=400,
-        content={"detail": "This endpoint is a WebSocket upgrade path. Use a WebSocket client to connect."},
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="This endpoint is a WebSocket upgrade path. Use a WebSocket client to connect.",
     )
 
 
@@ -257,21 +461,23 @@ async def websocket_endpoint(websocket: WebSocket):
     Behavior:
     - On connect, the server registers the subscription with the provided filters.
     - The server broadcasts notifications to all connections whose filters match.
-    - The server periodically pings clients by awaiting messages to detect disconnects.
+    - Liveness is checked with protocol-level WebSocket PING/PONG frames sent by the server
+      (uvicorn --ws-ping-interval/--ws-ping-timeout); clients do not need to send anything.
 
     Returns:
-    - Real-time stream of Notification JSON messages as text frames.
+    - Real-time stream of binary frames, each holding one or more length-prefixed Notification messages
+      ([4-byte big-endian length][UTF-8 JSON]).
+      Notifications published in quick succession are batched into a single frame.
     """
     user_id = websocket.query_params.get("userId")
     topic = websocket.query_params.get("topic")
 
     try:
         await manager.connect(websocket, user_id=user_id, topic=topic)
-        # Keep connection alive; wait for incoming messages to detect disconnects.
-        while True:
-            # We don't expect client messages; this await simply detects disconnects.
-            await websocket.receive_text()
-    except WebSocketDisconnect:
+        # Dead peers are detected by the server's PING/PONG keepalive, so there is nothing to read
+        # here: just wait for the disconnect event. Stray client frames are ignored, not decoded.
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
         await manager.disconnect(websocket)
     except Exception:
         # On unexpected errors, ensure cleanup
@@ -310,8 +516,18 @@ def health():
 
 if __name__ == "__main__":
     # Development server for local testing:
-    #   uvicorn app.main:app --host 0.0.0.0 --port 8106 --reload
+    #   uvicorn app.main:app --host 0.0.0.0 --port 8106 --loop uvloop \
+    #       --ws-ping-interval 20 --ws-ping-timeout 10 --reload
     import uvicorn
 
     port = int(os.getenv("PORT", "8106"))
-    uvicorn.run("app.main:app", host="0.0.0.0", port=port, reload=True)
+    # uvloop speeds up socket writes for WebSocket fan-out; PING/PONG keepalive detects dead clients.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        ws_ping_interval=20,
+        ws_ping_timeout=10,
+        reload=True,
+    )
@@ -3,4 +3,5 @@ set -euo pipefail
 export PYTHONUNBUFFERED=1
 PORT="${PORT:-8106}"
 HOST="${HOST:-0.0.0.0}"
-exec uvicorn app.main:app --host "${HOST}" --port "${PORT}" --reload
+exec uvicorn app.main:app --host "${HOST}" --port "${PORT}" --loop uvloop \
+  --ws-ping-interval 20 --ws-ping-timeout 10 --reload